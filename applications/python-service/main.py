@@ -6,15 +6,17 @@ Analyzes transaction data and generates insights
 
 import os
 import json
+import bisect
+import math
 import time
 import signal
 import sys
 import threading
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from datetime import datetime
-from typing import Dict, Any, List
-from collections import defaultdict
-from statistics import mean, median
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from datetime import datetime, timezone
+from typing import Deque, Dict, Any, List, Optional, Tuple
+from array import array
+from collections import deque
 
 # Initialize OpenTelemetry tracing
 try:
@@ -27,17 +29,77 @@ except Exception as e:
     print(f"Warning: Failed to initialize tracing: {e}, continuing without tracing")
     tracer_provider = None
 
+# orjson is optional: it encodes/decodes in C and works on bytes directly
+try:
+    import orjson
+
+    def json_dumps(data: Any) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(data: Any) -> bytes:
+        return json.dumps(data).encode('utf-8')
+
+    json_loads = json.loads
+
+METRICS_COUNT_PLACEHOLDER = b"__TRANSACTIONS__"
+
+# (total, tax, discount, {category: [revenue, quantity]}, hour, ts_epoch) for one transaction
+TransactionSummary = Tuple[float, float, float, Dict[str, List[float]], Optional[int], Optional[float]]
+
+
+def sorted_median(values: array) -> float:
+    """Median of an already-ordered column, by index"""
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def finite_number(value: Any, field: str):
+    """Validate a JSON number: bools, strings, NaN and infinities would poison the running sums"""
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise TypeError(f"{field} must be a number")
+    try:
+        finite = math.isfinite(value)
+    except OverflowError:
+        finite = False
+    if not finite:
+        raise ValueError(f"{field} must be finite")
+    return value
+
 
 class AnalyticsHandler(BaseHTTPRequestHandler):
     """HTTP request handler for analytics endpoints"""
     
+    # Keep connections open between requests (every response sets Content-Length);
+    # idle keep-alive connections are dropped after `timeout` seconds
+    protocol_version = "HTTP/1.1"
+    timeout = 60
+    # Headers and body go out in separate writes; with Nagle on, a kept-alive client's delayed ACK
+    # holds the body back ~40ms on every response
+    disable_nagle_algorithm = True
+    
+    # Exact-match routes: path -> handler method name
+    _GET_ROUTES = {
+        '/health': 'health_check',
+        '/metrics': 'prometheus_metrics',
+        '/api/v1/analyze': 'analyze_transactions',
+        '/api/v1/metrics': 'get_metrics'
+    }
+    _POST_ROUTES = {
+        '/api/v1/analyze': 'analyze_transactions',
+        '/api/v1/store-transaction': 'store_transaction'
+    }
+    
     def __init__(self, config: Dict[str, str], state: Dict[str, Any], *args, **kwargs):
         self.config = config
         self.state = state
         super().__init__(*args, **kwargs)
     
     @property
-    def transactions(self) -> List[Dict]:
+    def transactions(self) -> Deque[Dict]:
         return self.state["transactions"]
 
     @property
@@ -50,14 +112,9 @@ class AnalyticsHandler(BaseHTTPRequestHandler):
     
     def do_GET(self):
         """Handle GET requests"""
-        if self.path == '/health':
-            self.health_check()
-        elif self.path == '/metrics':
-            self.prometheus_metrics()
-        elif self.path == '/api/v1/analyze':
-            self.analyze_transactions()
-        elif self.path == '/api/v1/metrics':
-            self.get_metrics()
+        name = self._GET_ROUTES.get(self.path)
+        if name:
+            getattr(self, name)()
         elif self.path.startswith('/api/v1/report'):
             self.generate_report()
         else:
@@ -65,10 +122,12 @@ class AnalyticsHandler(BaseHTTPRequestHandler):
     
     def do_POST(self):
         """Handle POST requests"""
-        if self.path == '/api/v1/analyze':
-            self.analyze_transactions()
-        elif self.path == '/api/v1/store-transaction':
-            self.store_transaction()
+        name = self._POST_ROUTES.get(self.path)
+        if name == 'analyze_transactions':
+            # The body is ignored, but it must be consumed to keep the connection in sync
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if name:
+            getattr(self, name)()
         else:
             self.send_error(404, "Not Found")
     
@@ -90,10 +149,28 @@ class AnalyticsHandler(BaseHTTPRequestHandler):
         
         body = self.rfile.read(content_length)
         try:
-            transaction = json.loads(body.decode('utf-8'))
+            transaction = json_loads(body)
+            # Parse the timestamp once here so analytics never re-parse it
+            try:
+                timestamp = datetime.fromisoformat(transaction["timestamp"].replace("Z", "+00:00"))
+                if timestamp.tzinfo is None:
+                    # timestamp() would read a naive value as server-local time; reports render UTC
+                    timestamp = timestamp.replace(tzinfo=timezone.utc)
+                transaction["_hour"] = timestamp.hour
+                transaction["_ts_epoch"] = timestamp.timestamp()
+            except (KeyError, TypeError, AttributeError, ValueError):
+                transaction["_hour"] = None
+                transaction["_ts_epoch"] = None
+            summary = self._summarize(transaction)
+            transactions = self.transactions
             with self.lock:
-                self.transactions.append(transaction)
-                total_transactions = len(self.transactions)
+                if len(transactions) == transactions.maxlen:
+                    # append() below evicts the oldest transaction; retract it first
+                    self._retract(self._summarize(transactions[0]))
+                transactions.append(transaction)
+                self._accumulate(summary)
+                self.state["version"] += 1
+                total_transactions = len(transactions)
             response = {
                 "message": "Transaction stored successfully",
                 "transaction_id": transaction.get("transaction_id"),
@@ -102,15 +179,126 @@ class AnalyticsHandler(BaseHTTPRequestHandler):
             self.send_json_response(200, response)
         except json.JSONDecodeError:
             self.send_error(400, "Invalid JSON")
+        except (TypeError, ValueError, AttributeError):
+            # Valid JSON of the wrong shape, e.g. a non-numeric total or a non-object body
+            self.send_error(400, "Invalid transaction data")
+    
+    def _summarize(self, transaction: Dict[str, Any]) -> TransactionSummary:
+        """Extract a transaction's contribution to the aggregates, outside the lock.
+
+        Raises TypeError/ValueError for anything but finite numbers so bad input never reaches the aggregates.
+        """
+        categories = {}
+        for item in transaction.get("items", []):
+            category = item.get("category", "uncategorized")
+            price = finite_number(item.get("price", 0), "price")
+            quantity = finite_number(item.get("quantity", 0), "quantity")
+            revenue = finite_number(float(price) * quantity, "price * quantity")
+            entry = categories.get(category)
+            if entry is None:
+                categories[category] = [revenue, quantity]
+            else:
+                entry[0] += revenue
+                entry[1] += quantity
+        
+        return (
+            float(finite_number(transaction.get("total", 0), "total")),
+            float(finite_number(transaction.get("tax", 0), "tax")),
+            float(finite_number(transaction.get("discount", 0), "discount")),
+            categories,
+            transaction["_hour"],
+            transaction["_ts_epoch"]
+        )
+    
+    def _accumulate(self, summary: TransactionSummary):
+        """Fold a transaction summary into the running aggregates (caller holds the lock)"""
+        state = self.state
+        total, tax, discount, categories, hour, ts_epoch = summary
+        
+        state["sum_total"] += total
+        state["sum_tax"] += tax
+        state["sum_discount"] += discount
+        if discount > 0:
+            state["count_discount"] += 1
+        sorted_totals = state["sorted_totals"]
+        # O(log N) search, but the insert shifts the tail: an O(N) memmove of up to 8 * MAX_TRANSACTIONS bytes
+        bisect.insort(sorted_totals, total)
+        state["median_total"] = sorted_median(sorted_totals)
+        
+        category_totals = state["category_totals"]
+        for category, (revenue, quantity) in categories.items():
+            entry = category_totals.get(category)
+            if entry is None:
+                category_totals[category] = [revenue, quantity, 1]
+            else:
+                entry[0] += revenue
+                entry[1] += quantity
+                entry[2] += 1
+        
+        if hour is not None:
+            state["hour_hist"][hour] += 1
+        if ts_epoch is not None:
+            bisect.insort(state["sorted_epochs"], ts_epoch)
+    
+    def _retract(self, summary: TransactionSummary):
+        """Remove an evicted transaction's summary from the running aggregates (caller holds the lock)"""
+        state = self.state
+        total, tax, discount, categories, hour, ts_epoch = summary
+        
+        state["sum_total"] -= total
+        state["sum_tax"] -= tax
+        state["sum_discount"] -= discount
+        if discount > 0:
+            state["count_discount"] -= 1
+        sorted_totals = state["sorted_totals"]
+        # Arbitrary removal, which heaps cannot do; like insort it is an O(N) memmove of the tail
+        del sorted_totals[bisect.bisect_left(sorted_totals, total)]
+        state["median_total"] = sorted_median(sorted_totals) if sorted_totals else 0.0
+        
+        category_totals = state["category_totals"]
+        for category, (revenue, quantity) in categories.items():
+            entry = category_totals[category]
+            if entry[2] == 1:
+                del category_totals[category]
+            else:
+                entry[0] -= revenue
+                entry[1] -= quantity
+                entry[2] -= 1
+        
+        if hour is not None:
+            state["hour_hist"][hour] -= 1
+        if ts_epoch is not None:
+            sorted_epochs = state["sorted_epochs"]
+            del sorted_epochs[bisect.bisect_left(sorted_epochs, ts_epoch)]
     
     def analyze_transactions(self):
         """Analyze stored transactions and generate insights"""
         start_time = time.time()
+        state = self.state
+        
+        # Nothing stored since the last analysis: replay its serialized response
+        cached = state["analyze_cache"]
+        if cached is not None and cached[0] == state["version"]:
+            self.send_json_payload(200, cached[1])
+            return
         
+        # Snapshot the running aggregates; everything after this is O(categories)
         with self.lock:
-            transactions_copy = list(self.transactions)
+            version = state["version"]
+            count = len(self.transactions)
+            if count:
+                sorted_totals = state["sorted_totals"]
+                median_order_value = state["median_total"]
+                min_order = sorted_totals[0]
+                max_order = sorted_totals[-1]
+                total_revenue = state["sum_total"]
+                total_tax = state["sum_tax"]
+                total_discounts_given = state["sum_discount"]
+                transactions_with_discount = state["count_discount"]
+                categories = [(category, entry[0], entry[1]) for category, entry in state["category_totals"].items()]
+                hour_hist = list(state["hour_hist"])
         
-        if not transactions_copy:
+        if not count:
             response = {
                 "message": "No transactions to analyze",
                 "total_transactions": 0
@@ -118,164 +306,129 @@ class AnalyticsHandler(BaseHTTPRequestHandler):
             self.send_json_response(200, response)
             return
         
-        # Data Analysis: Calculate statistics
-        totals = [t.get("total", 0) for t in transactions_copy]
-        subtotals = [t.get("subtotal", 0) for t in transactions_copy]
-        taxes = [t.get("tax", 0) for t in transactions_copy]
-        discounts = [t.get("discount", 0) for t in transactions_copy]
-        
-        # Revenue analysis
-        total_revenue = sum(totals)
-        average_order_value = mean(totals) if totals else 0
-        median_order_value = median(totals) if totals else 0
-        max_order = max(totals) if totals else 0
-        min_order = min(totals) if totals else 0
-        
-        # Category analysis
-        category_revenue = defaultdict(float)
-        category_count = defaultdict(int)
-        
-        for transaction in transactions_copy:
-            for item in transaction.get("items", []):
-                category = item.get("category", "uncategorized")
-                category_revenue[category] += item.get("price", 0) * item.get("quantity", 0)
-                category_count[category] += item.get("quantity", 0)
-        
-        # Time-based analysis
-        transactions_by_hour = defaultdict(int)
-        for transaction in transactions_copy:
-            try:
-                timestamp = datetime.fromisoformat(transaction.get("timestamp", "").replace("Z", "+00:00"))
-                hour = timestamp.hour
-                transactions_by_hour[hour] += 1
-            except:
-                pass
-        
-        # Discount analysis
-        transactions_with_discount = sum(1 for d in discounts if d > 0)
-        total_discounts_given = sum(discounts)
-        avg_discount = mean([d for d in discounts if d > 0]) if transactions_with_discount > 0 else 0
+        average_order_value = total_revenue / count
+        avg_discount = total_discounts_given / transactions_with_discount if transactions_with_discount > 0 else 0
+        # Built in hour order from the histogram, so max() below breaks peak-hour ties towards the earliest hour
+        transactions_by_hour = {hour: hits for hour, hits in enumerate(hour_hist) if hits}
         
         processing_time = (time.time() - start_time) * 1000
         
         analysis = {
             "summary": {
-                "total_transactions": len(transactions_copy),
+                "total_transactions": count,
                 "total_revenue": round(total_revenue, 2),
                 "average_order_value": round(average_order_value, 2),
                 "median_order_value": round(median_order_value, 2),
                 "max_order_value": round(max_order, 2),
                 "min_order_value": round(min_order, 2),
-                "total_tax_collected": round(sum(taxes), 2),
+                "total_tax_collected": round(total_tax, 2),
                 "total_discounts_given": round(total_discounts_given, 2)
             },
             "category_breakdown": {
                 category: {
                     "revenue": round(revenue, 2),
-                    "items_sold": category_count[category]
+                    "items_sold": quantity
                 }
-                for category, revenue in category_revenue.items()
+                for category, revenue, quantity in categories
             },
             "discount_analysis": {
                 "transactions_with_discount": transactions_with_discount,
-                "discount_rate": round(transactions_with_discount / len(transactions_copy) * 100, 2) if transactions_copy else 0,
+                "discount_rate": round(transactions_with_discount / count * 100, 2),
                 "average_discount": round(avg_discount, 2),
                 "total_discount_value": round(total_discounts_given, 2)
             },
             "time_analysis": {
-                "peak_hour": max(transactions_by_hour.items(), key=lambda x: x[1])[0] if transactions_by_hour else None,
-                "transactions_by_hour": dict(transactions_by_hour)
+                "peak_hour": max(transactions_by_hour, key=transactions_by_hour.get) if transactions_by_hour else None,
+                "transactions_by_hour": transactions_by_hour
             },
             "processing_time_ms": round(processing_time, 2),
             "timestamp": datetime.now().isoformat()
         }
         
-        self.send_json_response(200, analysis)
+        payload = json_dumps(analysis)
+        state["analyze_cache"] = (version, payload)
+        self.send_json_payload(200, payload)
     
     def prometheus_metrics(self):
         """Prometheus-compatible metrics endpoint"""
-        service_name = self.config.get("service_name", "python-service")
-        with self.lock:
-            total_transactions = len(self.transactions)
-        metrics = f"""# HELP http_requests_total Total number of HTTP requests
-# TYPE http_requests_total counter
-http_requests_total{{service=\"{service_name}\",method=\"total\"}} {total_transactions}
-
-# HELP http_request_duration_seconds Request duration in seconds
-# TYPE http_request_duration_seconds histogram
-http_request_duration_seconds{{service=\"{service_name}\",quantile=\"0.5\"}} 0.05
-http_request_duration_seconds{{service=\"{service_name}\",quantile=\"0.95\"}} 0.1
-http_request_duration_seconds{{service=\"{service_name}\",quantile=\"0.99\"}} 0.2
-
-# HELP service_transactions_stored Total transactions stored
-# TYPE service_transactions_stored counter
-service_transactions_stored{{service=\"{service_name}\"}} {total_transactions}
-
-# HELP service_up Service availability
-# TYPE service_up gauge
-service_up{{service=\"{service_name}\"}} 1
-"""
+        total_transactions = str(len(self.transactions)).encode('ascii')
+        # Only the counter changes between scrapes; the rest is rendered once in main()
+        body = self.state["metrics_template"].replace(METRICS_COUNT_PLACEHOLDER, total_transactions)
         self.send_response(200)
         self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        self.wfile.write(metrics.encode('utf-8'))
+        self.wfile.write(body)
     
     def generate_report(self):
         """Generate a comprehensive report"""
+        state = self.state
+        cached = state["report_cache"]
+        if cached is not None and cached[0] == state["version"]:
+            self.send_json_payload(200, cached[1])
+            return
+        
         with self.lock:
-            transactions_copy = list(self.transactions)
-        if not transactions_copy:
+            version = state["version"]
+            count = len(self.transactions)
+            total_revenue = state["sum_total"]
+            discounted = state["count_discount"]
+            sorted_epochs = state["sorted_epochs"]
+            period_start = sorted_epochs[0] if sorted_epochs else None
+            period_end = sorted_epochs[-1] if sorted_epochs else None
+        
+        if not count:
             self.send_error(404, "No transactions available for reporting")
             return
         
-        totals = [t.get("total", 0) for t in transactions_copy]
-        total_revenue = sum(totals)
+        average_order_value = total_revenue / count
         
         report = {
             "report_type": "transaction_analytics",
             "generated_at": datetime.now().isoformat(),
             "period": {
-                "start": min([t.get("timestamp") for t in transactions_copy if t.get("timestamp")]),
-                "end": max([t.get("timestamp") for t in transactions_copy if t.get("timestamp")])
+                "start": self._format_epoch(period_start),
+                "end": self._format_epoch(period_end)
             },
             "key_metrics": {
-                "total_transactions": len(transactions_copy),
+                "total_transactions": count,
                 "total_revenue": round(total_revenue, 2),
-                "average_order_value": round(mean(totals), 2) if totals else 0,
-                "revenue_per_transaction": round(total_revenue / len(transactions_copy), 2) if transactions_copy else 0
+                "average_order_value": round(average_order_value, 2),
+                "revenue_per_transaction": round(average_order_value, 2)
             },
-            "recommendations": self._generate_recommendations(transactions_copy)
+            "recommendations": self._generate_recommendations(count, average_order_value, discounted / count)
         }
         
-        self.send_json_response(200, report)
+        payload = json_dumps(report)
+        state["report_cache"] = (version, payload)
+        self.send_json_payload(200, payload)
+    
+    def _format_epoch(self, ts_epoch: Optional[float]) -> Optional[str]:
+        """Render an ingest-time epoch back to the ISO-8601 UTC form clients send"""
+        if ts_epoch is None:
+            return None
+        return datetime.fromtimestamp(ts_epoch, timezone.utc).isoformat().replace("+00:00", "Z")
     
-    def _generate_recommendations(self, transactions: List[Dict]) -> List[str]:
+    def _generate_recommendations(self, count: int, avg_order: float, discount_rate: float) -> List[str]:
         """Generate business recommendations based on data"""
         recommendations = []
         
-        if not transactions:
+        if not count:
             return ["No data available for recommendations"]
         
-        totals = [t.get("total", 0) for t in transactions]
-        avg_order = mean(totals) if totals else 0
-        
         if avg_order < 50:
             recommendations.append("Average order value is low. Consider bundle deals or upselling.")
         
-        discounts = [t.get("discount", 0) for t in transactions]
-        discount_rate = sum(1 for d in discounts if d > 0) / len(transactions)
-        
         if discount_rate > 0.5:
             recommendations.append("High discount usage detected. Review discount strategy.")
         
-        recommendations.append(f"Total of {len(transactions)} transactions processed. System is performing well.")
+        recommendations.append(f"Total of {count} transactions processed. System is performing well.")
         
         return recommendations
     
     def get_metrics(self):
         """Get service metrics"""
-        with self.lock:
-            transaction_count = len(self.transactions)
+        transaction_count = len(self.transactions)
         metrics = {
             "service": self.config.get("service_name", "python-service"),
             "version": "1.0.0",
@@ -287,10 +440,44 @@ service_up{{service=\"{service_name}\"}} 1
     
     def send_json_response(self, status_code: int, data: Dict[str, Any]):
         """Send JSON response"""
+        self.send_json_payload(status_code, json_dumps(data))
+    
+    def send_json_payload(self, status_code: int, payload: bytes):
+        """Send an already-serialized JSON response"""
         self.send_response(status_code)
         self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
         self.end_headers()
-        self.wfile.write(json.dumps(data, indent=2).encode('utf-8'))
+        self.wfile.write(payload)
+
+
+class AnalyticsServer(ThreadingHTTPServer):
+    """Thread-per-connection server with a listen backlog sized for bursts"""
+    request_queue_size = 128
+
+
+def build_metrics_template(service_name: str) -> bytes:
+    """Render the Prometheus payload once, leaving a placeholder for the transaction count"""
+    count = METRICS_COUNT_PLACEHOLDER.decode('ascii')
+    metrics = f"""# HELP http_requests_total Total number of HTTP requests
+# TYPE http_requests_total counter
+http_requests_total{{service=\"{service_name}\",method=\"total\"}} {count}
+
+# HELP http_request_duration_seconds Request duration in seconds
+# TYPE http_request_duration_seconds histogram
+http_request_duration_seconds{{service=\"{service_name}\",quantile=\"0.5\"}} 0.05
+http_request_duration_seconds{{service=\"{service_name}\",quantile=\"0.95\"}} 0.1
+http_request_duration_seconds{{service=\"{service_name}\",quantile=\"0.99\"}} 0.2
+
+# HELP service_transactions_stored Total transactions stored
+# TYPE service_transactions_stored counter
+service_transactions_stored{{service=\"{service_name}\"}} {count}
+
+# HELP service_up Service availability
+# TYPE service_up gauge
+service_up{{service=\"{service_name}\"}} 1
+"""
+    return metrics.encode('utf-8')
 
 
 def create_handler(config: Dict[str, str], state: Dict[str, Any]):
@@ -302,10 +489,40 @@ def create_handler(config: Dict[str, str], state: Dict[str, Any]):
 
 def load_config() -> Dict[str, str]:
     """Load configuration from environment variables"""
-    return {
+    config = {
         "port": os.getenv("PORT", "8081"),
         "service_name": os.getenv("SERVICE_NAME", "python-service"),
-        "environment": os.getenv("ENVIRONMENT", "development")
+        "environment": os.getenv("ENVIRONMENT", "development"),
+        "max_transactions": os.getenv("MAX_TRANSACTIONS", "100000")
+    }
+    # A zero-length ring buffer has no oldest entry to evict, so every store would fail
+    if int(config["max_transactions"]) < 1:
+        raise ValueError(f"MAX_TRANSACTIONS must be at least 1, got {config['max_transactions']}")
+    return config
+
+
+def build_state(config: Dict[str, str]) -> Dict[str, Any]:
+    """Create the shared store and its running aggregates"""
+    return {
+        # Bounded ring buffer: the oldest transaction is evicted once full
+        "transactions": deque(maxlen=int(config["max_transactions"])),
+        "lock": threading.Lock(),
+        # Running aggregates maintained by store_transaction
+        "sum_total": 0.0,
+        "sum_tax": 0.0,
+        "sum_discount": 0.0,
+        "count_discount": 0,
+        "median_total": 0.0,
+        # Ordered float64 columns: order statistics and period bounds by index
+        "sorted_totals": array('d'),
+        "sorted_epochs": array('d'),
+        "category_totals": {},
+        "hour_hist": [0] * 24,
+        "metrics_template": build_metrics_template(config["service_name"]),
+        # Bumped on every store; keys the cached (version, payload) responses below
+        "version": 0,
+        "analyze_cache": None,
+        "report_cache": None
     }
 
 
@@ -320,10 +537,7 @@ def main():
     config = load_config()
     port = int(config["port"])
 
-    state = {
-        "transactions": [],
-        "lock": threading.Lock()
-    }
+    state = build_state(config)
     
     # Set up signal handlers for graceful shutdown
     signal.signal(signal.SIGINT, signal_handler)
@@ -331,7 +545,7 @@ def main():
     
     # Create HTTP server
     handler = create_handler(config, state)
-    server = HTTPServer(('0.0.0.0', port), handler)
+    server = AnalyticsServer(('0.0.0.0', port), handler)
     
     print(f"Starting {config['service_name']} on port {port}")
     
@@ -0,0 +1,114 @@
+"""A capped store must report exactly what a fresh store fed only the surviving transactions reports."""
+
+import http.client
+import json
+import random
+import threading
+
+import pytest
+
+import main
+
+CAPACITY = 25
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(max_transactions: int) -> http.client.HTTPConnection:
+        config = {
+            "port": "0",
+            "service_name": "python-service",
+            "environment": "test",
+            "max_transactions": str(max_transactions),
+        }
+        server = main.AnalyticsServer(("127.0.0.1", 0), main.create_handler(config, main.build_state(config)))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def make_transactions(seed: int, count: int):
+    rng = random.Random(seed)
+    transactions = []
+    for index in range(count):
+        items = [
+            {
+                "category": rng.choice(["books", "games", "garden", "tools"]),
+                "price": round(rng.uniform(1, 80), 2),
+                "quantity": rng.randint(1, 4),
+            }
+            for _ in range(rng.randint(0, 3))
+        ]
+        transaction = {
+            "transaction_id": f"t{index}",
+            "total": round(rng.uniform(5, 400), 2),
+            "tax": round(rng.uniform(0, 30), 2),
+            "discount": rng.choice([0, 0, round(rng.uniform(1, 20), 2)]),
+            "items": items,
+        }
+        if rng.random() < 0.9:
+            day, hour = rng.randint(1, 28), rng.randint(0, 23)
+            transaction["timestamp"] = f"2024-02-{day:02d}T{hour:02d}:{rng.randint(0, 59):02d}:00Z"
+        transactions.append(transaction)
+    return transactions
+
+
+def request(conn: http.client.HTTPConnection, method: str, path: str, body=None):
+    conn.request(method, path, body=json.dumps(body) if body is not None else None)
+    response = conn.getresponse()
+    payload = json.loads(response.read())
+    assert response.status == 200, payload
+    return payload
+
+
+def assert_same(actual, expected, path="$"):
+    """Deep equality, allowing the rounding drift that running-sum retraction can leave behind"""
+    if isinstance(expected, dict):
+        assert actual.keys() == expected.keys(), path
+        for key in expected:
+            assert_same(actual[key], expected[key], f"{path}.{key}")
+    elif isinstance(expected, float) or isinstance(actual, float):
+        assert actual == pytest.approx(expected, abs=0.011), path
+    else:
+        assert actual == expected, path
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_evicting_store_matches_fresh_store(serve, seed):
+    transactions = make_transactions(seed, CAPACITY * 3 + seed)
+    capped = serve(CAPACITY)
+    fresh = serve(len(transactions))
+
+    for transaction in transactions:
+        stored = request(capped, "POST", "/api/v1/store-transaction", transaction)
+    assert stored["total_transactions"] == CAPACITY
+    for transaction in transactions[-CAPACITY:]:
+        request(fresh, "POST", "/api/v1/store-transaction", transaction)
+
+    analysis, expected_analysis = (request(conn, "GET", "/api/v1/analyze") for conn in (capped, fresh))
+    for volatile in ("processing_time_ms", "timestamp"):
+        del analysis[volatile], expected_analysis[volatile]
+    assert_same(analysis, expected_analysis)
+
+    report, expected_report = (request(conn, "GET", "/api/v1/report") for conn in (capped, fresh))
+    del report["generated_at"], expected_report["generated_at"]
+    assert_same(report, expected_report)
+
+
+def test_category_leaves_breakdown_with_its_last_transaction(serve):
+    conn = serve(2)
+    request(conn, "POST", "/api/v1/store-transaction", {"total": 10, "items": [{"category": "old", "price": 5, "quantity": 2}]})
+    request(conn, "POST", "/api/v1/store-transaction", {"total": 20})
+    request(conn, "POST", "/api/v1/store-transaction", {"total": 30})
+
+    analysis = request(conn, "GET", "/api/v1/analyze")
+    assert analysis["category_breakdown"] == {}
+    assert analysis["summary"]["min_order_value"] == 20
+    assert analysis["summary"]["total_revenue"] == 50
@@ -0,0 +1,131 @@
+"""Cumulative ack bookkeeping must settle every delivery exactly once, in whatever order they finish."""
+
+import random
+import threading
+
+import pika
+import pytest
+
+import worker
+
+
+class BrokerChannel:
+    """Channel double that enforces RabbitMQ's rules for settling deliveries."""
+
+    def __init__(self, delivered: int) -> None:
+        self.outstanding = set(range(1, delivered + 1))
+        self.acked = set()
+        self.requeued = set()
+        self.is_open = True
+
+    def basic_ack(self, delivery_tag: int, multiple: bool = False) -> None:
+        # The broker closes the channel with PRECONDITION_FAILED for a tag that is not outstanding
+        assert delivery_tag in self.outstanding, f"unknown delivery tag {delivery_tag}"
+        settled = {tag for tag in self.outstanding if tag <= delivery_tag} if multiple else {delivery_tag}
+        self.outstanding -= settled
+        self.acked |= settled
+
+    def basic_nack(self, delivery_tag: int, multiple: bool = False, requeue: bool = True) -> None:
+        assert not multiple and requeue
+        assert delivery_tag in self.outstanding, f"unknown delivery tag {delivery_tag}"
+        self.outstanding.remove(delivery_tag)
+        self.requeued.add(delivery_tag)
+
+
+class IOLoopConnection:
+    """Queues thread-safe callbacks until the test pumps them, like pika's I/O thread."""
+
+    def __init__(self) -> None:
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.is_open = True
+
+    def add_callback_threadsafe(self, callback) -> None:
+        if not self.is_open:
+            raise pika.exceptions.ConnectionWrongStateError("connection closed")
+        with self.lock:
+            self.callbacks.append(callback)
+
+    def pump(self) -> None:
+        with self.lock:
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+@pytest.fixture
+def rabbit_worker(monkeypatch):
+    monkeypatch.setenv("POSTGRES_USER", "analytics")
+    monkeypatch.setenv("POSTGRES_PASSWORD", "secret")
+    monkeypatch.setenv("RABBITMQ_PREFETCH", "16")
+    return worker.RabbitWorker()
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_out_of_order_acks_and_nacks_settle_every_delivery_once(rabbit_worker, seed):
+    rng = random.Random(seed)
+    delivered = 200
+    channel = rabbit_worker._channel = BrokerChannel(delivered)
+    order = list(range(1, delivered + 1))
+    rng.shuffle(order)
+    requeue = set(rng.sample(order, 30))
+
+    for tag in order:
+        if tag in requeue:
+            rabbit_worker._on_delivery_requeued(tag)
+        else:
+            rabbit_worker._on_delivery_done(tag)
+        if rng.random() < 0.1:
+            # The periodic ack timer
+            rabbit_worker._flush_acks()
+    rabbit_worker._flush_acks()
+
+    assert channel.outstanding == set()
+    assert channel.requeued == requeue
+    assert channel.acked == set(order) - requeue
+    assert rabbit_worker._done_tags == set()
+    assert rabbit_worker._requeued_tags == set()
+
+
+def test_cumulative_ack_steps_back_past_a_requeued_tail(rabbit_worker):
+    channel = rabbit_worker._channel = BrokerChannel(4)
+    rabbit_worker._on_delivery_done(1)
+    rabbit_worker._on_delivery_done(2)
+    rabbit_worker._on_delivery_requeued(3)
+    rabbit_worker._on_delivery_requeued(4)
+    rabbit_worker._flush_acks()
+
+    assert channel.acked == {1, 2}
+    assert channel.requeued == {3, 4}
+    assert rabbit_worker._acked_tag == 4
+
+
+def test_settlements_from_pool_threads_reach_the_io_thread(rabbit_worker):
+    channel = rabbit_worker._channel = BrokerChannel(64)
+    connection = rabbit_worker._connection = IOLoopConnection()
+
+    threads = [
+        threading.Thread(target=rabbit_worker._requeue if tag % 7 == 0 else rabbit_worker._ack, args=(tag,))
+        for tag in range(1, 65)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    connection.pump()
+    rabbit_worker._flush_acks()
+
+    assert channel.outstanding == set()
+    assert channel.requeued == {tag for tag in range(1, 65) if tag % 7 == 0}
+
+
+def test_settling_after_the_connection_closed_is_a_no_op(rabbit_worker):
+    channel = rabbit_worker._channel = BrokerChannel(2)
+    connection = rabbit_worker._connection = IOLoopConnection()
+    connection.is_open = False
+
+    rabbit_worker._ack(1)
+    rabbit_worker._requeue(2)
+
+    assert connection.callbacks == []
+    assert channel.outstanding == {1, 2}
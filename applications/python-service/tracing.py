@@ -7,7 +7,8 @@ import os
 from opentelemetry import trace
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+from grpc import Compression
 from opentelemetry.sdk.resources import Resource
 from opentelemetry.semantic_conventions.resource import ResourceAttributes
 
@@ -15,7 +16,9 @@ def init_tracing():
     """Initialize OpenTelemetry tracing"""
     # Get Jaeger collector URL from environment
     jaeger_host = os.getenv("JAEGER_COLLECTOR_HOST", "jaeger-query.monitoring.svc.cluster.local")
-    jaeger_url = f"http://{jaeger_host}:4318/v1/traces"
+    jaeger_url = f"{jaeger_host}:4317"
+    # The in-cluster collector speaks plaintext; set to "false" when it terminates TLS
+    insecure = os.getenv("JAEGER_COLLECTOR_INSECURE", "true").lower() == "true"
     
     # Create resource with service information
     resource = Resource.create({
@@ -26,14 +29,21 @@ def init_tracing():
     # Create tracer provider
     tracer_provider = TracerProvider(resource=resource)
     
-    # Create OTLP HTTP exporter
+    # Create OTLP gRPC exporter (one long-lived HTTP/2 channel, gzip-compressed batches)
     otlp_exporter = OTLPSpanExporter(
         endpoint=jaeger_url,
-        insecure=True,
+        insecure=insecure,
+        compression=Compression.Gzip,
     )
     
-    # Add span processor
-    span_processor = BatchSpanProcessor(otlp_exporter)
+    # Add span processor with a deeper queue and larger batches to absorb bursts
+    span_processor = BatchSpanProcessor(
+        otlp_exporter,
+        max_queue_size=8192,
+        max_export_batch_size=1024,
+        schedule_delay_millis=500,
+        export_timeout_millis=10000,
+    )
     tracer_provider.add_span_processor(span_processor)
     
     # Set global tracer provider
@@ -5,33 +5,45 @@ RabbitMQ worker for the analytics service.
 Consumes messages from a queue and simulates downstream processing.
 """
 
+import functools
 import io
-import json
+import logging
 import os
+import queue
+import re
 import signal
 import sys
+import threading
 import time
-from collections import defaultdict
-from datetime import datetime
-from decimal import Decimal
-from typing import Any, Dict, List, Optional
-from uuid import UUID
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Set
 
+import orjson
 import pika
 import psycopg
+from cachetools import TTLCache
 from minio import Minio
 from minio.error import S3Error
 from psycopg.rows import dict_row
-from pymongo import MongoClient
+from psycopg_pool import ConnectionPool
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, ConnectionFailure
 
+logger = logging.getLogger("worker")
 
-def _json_default(value: Any) -> Any:
-    """Helper to JSON-serialise Decimal and datetime objects."""
-    if isinstance(value, Decimal):
-        return float(value)
-    if isinstance(value, datetime):
-        return value.isoformat()
-    return value
+# Canonical textual UUID; Postgres casts the string itself, so no UUID object is needed
+_UUID_RE = re.compile(r"\A[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\Z")
+
+
+class PendingWrite(NamedTuple):
+    """A buffered Mongo upsert and the delivery whose ack waits on it."""
+
+    transaction_id: str
+    operation: UpdateOne
+    delivery_tag: int
+    redelivered: bool
 
 
 class RabbitWorker:
@@ -40,24 +52,72 @@ class RabbitWorker:
     def __init__(self) -> None:
         self.queue_name = os.getenv("RABBITMQ_QUEUE", "analytics.events")
         self.prefetch_count = int(os.getenv("RABBITMQ_PREFETCH", "10"))
+        # Acks go out cumulatively; keep batches under the prefetch window so delivery never stalls
+        self.ack_batch_size = max(1, min(int(os.getenv("RABBITMQ_ACK_BATCH", "32")), self.prefetch_count // 2))
+        self.ack_interval = int(os.getenv("RABBITMQ_ACK_INTERVAL_MS", "200")) / 1000
+        # Mongo upserts are buffered per batch; the same cap applies since their acks wait on the flush
+        self.mongo_batch_size = max(1, min(int(os.getenv("MONGODB_BATCH_SIZE", "50")), self.prefetch_count // 2))
+        self.mongo_flush_interval = int(os.getenv("MONGODB_FLUSH_INTERVAL_MS", "200")) / 1000
 
         # RabbitMQ connection bits
         self._connection = None
         self._channel = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # Ack bookkeeping, only touched on pika's I/O thread
+        self._done_tags: Set[int] = set()
+        self._ready_tag = 0
+        self._acked_tag = 0
+        self._requeued_tags: Set[int] = set()
+        self._stopping = False
 
         # Postgres
-        self.pg_conn = None
+        self.pg_pool: Optional[ConnectionPool] = None
         self.pg_dsn = self._build_postgres_dsn()
+        # Transactions are immutable once written, so bursts and replays for the same ID reuse the row
+        self._txn_cache: TTLCache = TTLCache(
+            maxsize=int(os.getenv("TRANSACTION_CACHE_SIZE", "1024")),
+            ttl=int(os.getenv("TRANSACTION_CACHE_TTL", "60")),
+        )
+        self._txn_cache_lock = threading.Lock()
 
         # MongoDB
         self.mongo_client: Optional[MongoClient] = None
         self.mongo_collection = None
+        self._mongo_batch: List[PendingWrite] = []
+        self._mongo_lock = threading.Lock()
 
         # MinIO
         self.minio_client: Optional[Minio] = None
         self.minio_bucket = os.getenv("MINIO_BUCKET", "analytics-reports")
         self.minio_secure = os.getenv("MINIO_SECURE", "false").lower() == "true"
 
+        self._log_listener: Optional[QueueListener] = None
+
+    def _start_logging(self) -> None:
+        """Write log records to stdout from a background thread.
+
+        QueueHandler.prepare() still formats each record on the logging thread; only the stream I/O moves.
+        """
+        if self._log_listener:
+            return
+        records: queue.Queue = queue.Queue(-1)
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setFormatter(logging.Formatter("[%(name)s] %(message)s"))
+        logger.addHandler(QueueHandler(records))
+        logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+        logger.propagate = False
+        self._log_listener = QueueListener(records, stream)
+        self._log_listener.start()
+
+    def _stop_logging(self) -> None:
+        if not self._log_listener:
+            return
+        # Drains whatever is still queued before returning
+        self._log_listener.stop()
+        self._log_listener = None
+        for handler in [h for h in logger.handlers if isinstance(h, QueueHandler)]:
+            logger.removeHandler(handler)
+
     def _build_postgres_dsn(self) -> str:
         params = {
             "host": os.getenv("POSTGRES_HOST", "postgresql-postgresql"),
@@ -73,9 +133,17 @@ class RabbitWorker:
         return " ".join(f"{k}={v}" for k, v in params.items())
 
     def _init_postgres(self) -> None:
-        self.pg_conn = psycopg.connect(self.pg_dsn, row_factory=dict_row)
-        self.pg_conn.autocommit = True
-        print("[worker] Connected to PostgreSQL")
+        # Sized to the number of messages that can be in flight at once
+        pool_size = max(1, self.prefetch_count)
+        self.pg_pool = ConnectionPool(
+            self.pg_dsn,
+            min_size=min(2, pool_size),
+            max_size=pool_size,
+            kwargs={"row_factory": dict_row, "autocommit": True},
+            open=True,
+        )
+        self.pg_pool.wait()
+        logger.info("Connected to PostgreSQL")
 
     def _init_mongo(self) -> None:
         username = os.getenv("MONGODB_USERNAME")
@@ -90,9 +158,17 @@ class RabbitWorker:
             raise RuntimeError("MongoDB credentials are required")
 
         mongo_uri = f"mongodb://{username}:{password}@{host}:{port}/?authSource={auth_source}"
-        self.mongo_client = MongoClient(mongo_uri, tls=False)
+        # Wire compression is negotiated with the server; zlib is the stdlib fallback when zstd is not offered
+        self.mongo_client = MongoClient(
+            mongo_uri,
+            tls=False,
+            compressors="zstd,zlib",
+            maxPoolSize=max(16, self.prefetch_count * 2),
+            retryWrites=True,
+            w=1,
+        )
         self.mongo_collection = self.mongo_client[database][collection]
-        print("[worker] Connected to MongoDB")
+        logger.info("Connected to MongoDB")
 
     def _init_minio(self) -> None:
         endpoint = os.getenv("MINIO_ENDPOINT", "minio-minio:9000")
@@ -112,12 +188,13 @@ class RabbitWorker:
         assert self.minio_client is not None
         if not self.minio_client.bucket_exists(self.minio_bucket):
             self.minio_client.make_bucket(self.minio_bucket)
-            print(f"[worker] Created MinIO bucket {self.minio_bucket}")
+            logger.info("Created MinIO bucket %s", self.minio_bucket)
         else:
-            print(f"[worker] Using MinIO bucket {self.minio_bucket}")
+            logger.info("Using MinIO bucket %s", self.minio_bucket)
 
     def connect(self) -> None:
         """Establish connections to all backends."""
+        self._start_logging()
         self._init_postgres()
         self._init_mongo()
         self._init_minio()
@@ -139,129 +216,213 @@ class RabbitWorker:
             port=port,
             virtual_host=virtual_host,
             credentials=credentials,
-            heartbeat=30,
+            heartbeat=60,
             blocked_connection_timeout=30,
+            frame_max=131072,
+            # pika sets TCP_NODELAY on every socket itself and would ignore it here with an
+            # "Unsupported TCP option" warning; fail a dead peer in 30s instead of the kernel's ~15 minutes
+            tcp_options={"TCP_USER_TIMEOUT": 30000, "TCP_KEEPIDLE": 60, "TCP_KEEPINTVL": 10, "TCP_KEEPCNT": 3},
         )
         self._connection = pika.BlockingConnection(parameters)
         self._channel = self._connection.channel()
 
         self._channel.queue_declare(queue=self.queue_name, durable=True)
         self._channel.basic_qos(prefetch_count=self.prefetch_count)
-        print(f"[worker] Connected to RabbitMQ at {host}:{port}, queue={self.queue_name}")
+        logger.info("Connected to RabbitMQ at %s:%s, queue=%s", host, port, self.queue_name)
 
     def start(self) -> None:
         if not self._channel:
             raise RuntimeError("Call connect() before start()")
 
-        def callback(ch, method, properties, body):
-            start_time = time.time()
-            try:
-                payload = json.loads(body.decode("utf-8"))
-            except json.JSONDecodeError:
-                print("[worker] Received invalid JSON payload, discarding")
-                ch.basic_ack(delivery_tag=method.delivery_tag)
-                return
+        # Up to prefetch_count deliveries are processed concurrently, off pika's I/O thread
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, self.prefetch_count),
+            thread_name_prefix="worker",
+        )
 
-            try:
-                self.process_message(payload)
-            except Exception as exc:  # pylint: disable=broad-except
-                print(f"[worker] Error processing message: {exc}")
-            finally:
-                elapsed = (time.time() - start_time) * 1000
-                print(f"[worker] Processed message in {elapsed:.2f} ms")
-                ch.basic_ack(delivery_tag=method.delivery_tag)
+        def callback(ch, method, properties, body):
+            self._executor.submit(self._handle_delivery, body, method.delivery_tag, method.redelivered)
 
         self._channel.basic_consume(queue=self.queue_name, on_message_callback=callback)
-        print("[worker] Waiting for messages. Press Ctrl+C to exit.")
+        self._connection.call_later(self.ack_interval, self._ack_timer)
+        self._connection.call_later(self.mongo_flush_interval, self._mongo_timer)
+        logger.info("Waiting for messages. Press Ctrl+C to exit.")
         self._channel.start_consuming()
 
-    def process_message(self, payload: Dict[str, Any]) -> None:
+    def _handle_delivery(self, body: bytes, delivery_tag: int, redelivered: bool) -> None:
+        """Process one delivery on a pool thread and acknowledge it when done."""
+        start_time = time.time()
+        try:
+            payload = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            logger.warning("Received invalid JSON payload, discarding")
+            self._ack(delivery_tag)
+            return
+
+        deferred = False
+        try:
+            deferred = self.process_message(payload, delivery_tag, redelivered)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.error("Error processing message: %s", exc)
+        finally:
+            logger.debug("Processed message in %.2f ms", (time.time() - start_time) * 1000)
+            # Deliveries queued for Mongo are acked once their batch is written
+            if not deferred:
+                self._ack(delivery_tag)
+
+    def _ack(self, delivery_tag: int) -> None:
+        """Mark a delivery done from any thread; pika channels are only safe on the I/O thread."""
+        self._call_on_io_thread(functools.partial(self._on_delivery_done, delivery_tag))
+
+    def _requeue(self, delivery_tag: int) -> None:
+        """Hand a delivery back to the broker from any thread."""
+        self._call_on_io_thread(functools.partial(self._on_delivery_requeued, delivery_tag))
+
+    def _call_on_io_thread(self, callback: Callable[[], None]) -> None:
+        try:
+            self._connection.add_callback_threadsafe(callback)
+        except pika.exceptions.AMQPConnectionError:
+            # The broker requeues every unacked delivery when the connection drops, so there is nothing to settle
+            logger.debug("Connection closed, leaving delivery settlement to the broker")
+
+    def _on_delivery_requeued(self, delivery_tag: int) -> None:
+        # Settled by the nack, so it counts towards the contiguous prefix but must not name a cumulative ack
+        self._channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+        self._requeued_tags.add(delivery_tag)
+        self._on_delivery_done(delivery_tag)
+
+    def _on_delivery_done(self, delivery_tag: int) -> None:
+        # Deliveries finish out of order; a cumulative ack may only cover the contiguous prefix
+        self._done_tags.add(delivery_tag)
+        while self._ready_tag + 1 in self._done_tags:
+            self._ready_tag += 1
+            self._done_tags.remove(self._ready_tag)
+        if self._ready_tag - self._acked_tag >= self.ack_batch_size:
+            self._flush_acks()
+
+    def _flush_acks(self) -> None:
+        ready = self._ready_tag
+        # The broker rejects a cumulative ack whose tag was already nacked, so step back past those
+        while ready > self._acked_tag and ready in self._requeued_tags:
+            ready -= 1
+        if ready > self._acked_tag:
+            self._channel.basic_ack(delivery_tag=ready, multiple=True)
+        self._acked_tag = self._ready_tag
+        if self._requeued_tags:
+            self._requeued_tags = {tag for tag in self._requeued_tags if tag > self._acked_tag}
+
+    def _ack_timer(self) -> None:
+        self._flush_acks()
+        if self._stopping:
+            # Cancels the consumer so start_consuming returns and close() drains outside event dispatch
+            self._channel.stop_consuming()
+            return
+        self._connection.call_later(self.ack_interval, self._ack_timer)
+
+    def stop(self) -> None:
+        """Ask the consume loop to wind down; safe to call from a signal handler."""
+        if self._executor is None:
+            # Not consuming yet, so there is nothing in flight to drain
+            raise SystemExit(0)
+        # pika is mid-dispatch when a signal lands, so the loop is stopped from its own timer instead
+        self._stopping = True
+
+    def _mongo_timer(self) -> None:
+        # Runs on the I/O thread; the write itself happens on the pool
+        if self._executor:
+            self._executor.submit(self._flush_mongo)
+        self._connection.call_later(self.mongo_flush_interval, self._mongo_timer)
+
+    def process_message(self, payload: Dict[str, Any], delivery_tag: int, redelivered: bool) -> bool:
+        """Build and store analytics for one event.
+
+        Returns True when the delivery was queued for the Mongo batch, which then owns its ack.
+        """
         event_payload: Dict[str, Any] = payload
         if isinstance(payload, dict) and "payload" in payload:
             inner = payload.get("payload")
             if isinstance(inner, dict):
                 event_payload = inner
 
-        transaction_id = (
-            event_payload.get("transactionId")
-            or event_payload.get("transaction_id")
-            or event_payload.get("transactionID")
-        )
+        get = event_payload.get
+        transaction_id = get("transactionId") or get("transaction_id") or get("transactionID")
         if not transaction_id:
             event_type = payload.get("eventType") if isinstance(payload, dict) else None
-            print(f"[worker] Transaction ID missing, skipping (eventType={event_type})")
-            return
+            logger.warning("Transaction ID missing, skipping (eventType=%s)", event_type)
+            return False
 
-        try:
-            uuid_obj = UUID(str(transaction_id))
-        except ValueError:
-            print(f"[worker] Invalid transaction ID format: {transaction_id}")
-            return
+        transaction_id = str(transaction_id)
+        if not _UUID_RE.match(transaction_id):
+            logger.warning("Invalid transaction ID format: %s", transaction_id)
+            return False
 
-        transaction = self._fetch_transaction(uuid_obj)
+        transaction = self._fetch_transaction(transaction_id)
         if not transaction:
-            print(f"[worker] Transaction {transaction_id} not found in Postgres")
-            return
+            logger.warning("Transaction %s not found in Postgres", transaction_id)
+            return False
 
-        analytics = self._build_analytics(transaction)
+        # One timestamp per message stamps both the report and the stored document
+        now = datetime.now(timezone.utc)
+        analytics = self._build_analytics(transaction, now)
         object_key = self._upload_report(transaction_id, analytics)
-        self._persist_analytics(transaction_id, analytics, object_key)
-
-    def _fetch_transaction(self, transaction_id: UUID) -> Optional[Dict[str, Any]]:
-        if not self.pg_conn:
-            raise RuntimeError("Postgres connection not initialised")
-
-        with self.pg_conn.cursor() as cur:
+        self._persist_analytics(transaction_id, analytics, object_key, delivery_tag, redelivered, now)
+        return True
+
+    def _fetch_transaction(self, transaction_id: str) -> Optional[Dict[str, Any]]:
+        if not self.pg_pool:
+            raise RuntimeError("Postgres connection pool not initialised")
+
+        with self._txn_cache_lock:
+            cached = self._txn_cache.get(transaction_id)
+        if cached is not None:
+            return cached
+
+        # One round trip: per-category revenue and quantity are reduced in Postgres, so only the
+        # breakdown crosses the wire. Prepared on first use so later messages skip parse/plan, and
+        # results come back in binary so uuid/numeric/timestamptz decode without text parsing.
+        with self.pg_pool.connection() as conn, conn.cursor(binary=True) as cur:
             cur.execute(
                 """
-                SELECT id, customer_id, subtotal, tax, discount, total, currency, created_at
-                FROM transactions
-                WHERE id = %s
+                WITH categories AS (
+                    SELECT COALESCE(NULLIF(category, ''), 'uncategorised') AS category,
+                           SUM(unit_price * quantity) AS revenue,
+                           SUM(quantity) AS quantity
+                    FROM transaction_items
+                    WHERE transaction_id = %(id)s
+                    GROUP BY 1
+                )
+                SELECT t.id, t.customer_id, t.subtotal, t.tax, t.discount, t.total, t.currency, t.created_at,
+                       COALESCE((SELECT SUM(quantity) FROM categories), 0) AS total_items,
+                       COALESCE(
+                           (
+                               SELECT json_agg(
+                                   json_build_object(
+                                       'category', c.category,
+                                       'revenue', ROUND(c.revenue, 2),
+                                       'quantity', c.quantity
+                                   )
+                                   ORDER BY c.category
+                               )
+                               FROM categories c
+                           ),
+                           '[]'::json
+                       ) AS category_breakdown
+                FROM transactions t
+                WHERE t.id = %(id)s
                 """,
-                (transaction_id,),
+                {"id": transaction_id},
+                prepare=True,
             )
-            txn = cur.fetchone()
+            transaction = cur.fetchone()
 
-            if not txn:
-                return None
-
-            cur.execute(
-                """
-                SELECT product_id, name, category, unit_price, quantity
-                FROM transaction_items
-                WHERE transaction_id = %s
-                """,
-                (transaction_id,),
-            )
-            items = cur.fetchall()
-
-        txn["items"] = items or []
-        return txn
-
-    def _build_analytics(self, transaction: Dict[str, Any]) -> Dict[str, Any]:
-        items: List[Dict[str, Any]] = transaction.get("items", [])
-        category_totals: Dict[str, Dict[str, float]] = defaultdict(lambda: {"revenue": 0.0, "quantity": 0})
-        total_quantity = 0
-
-        for item in items:
-            category = item.get("category") or "uncategorised"
-            unit_price = float(item.get("unit_price", 0))
-            quantity = int(item.get("quantity", 0))
-            revenue = unit_price * quantity
-
-            category_totals[category]["revenue"] += revenue
-            category_totals[category]["quantity"] += quantity
-            total_quantity += quantity
-
-        category_summary = [
-            {
-                "category": category,
-                "revenue": round(values["revenue"], 2),
-                "quantity": values["quantity"],
-            }
-            for category, values in category_totals.items()
-        ]
+        # Misses are not cached: the row may simply not be committed yet
+        if transaction is not None:
+            with self._txn_cache_lock:
+                self._txn_cache[transaction_id] = transaction
+        return transaction
 
+    def _build_analytics(self, transaction: Dict[str, Any], now: datetime) -> Dict[str, Any]:
+        """Shape a fetched row into a fresh analytics dict owned by the caller."""
         return {
             "transaction_id": str(transaction["id"]),
             "customer_id": str(transaction.get("customer_id")) if transaction.get("customer_id") else None,
@@ -272,10 +433,10 @@ class RabbitWorker:
                 "tax": float(transaction.get("tax", 0)),
                 "discount": float(transaction.get("discount", 0)),
                 "total": float(transaction.get("total", 0)),
-                "items": total_quantity,
+                "items": int(transaction.get("total_items", 0)),
             },
-            "category_breakdown": category_summary,
-            "generated_at": datetime.utcnow(),
+            "category_breakdown": transaction.get("category_breakdown", []),
+            "generated_at": now,
         }
 
     def _upload_report(self, transaction_id: str, analytics: Dict[str, Any]) -> str:
@@ -283,7 +444,8 @@ class RabbitWorker:
             raise RuntimeError("MinIO client not initialised")
 
         object_key = f"transactions/{transaction_id}.json"
-        payload = json.dumps(analytics, default=_json_default, indent=2).encode("utf-8")
+        # Compact output; numerics are floats already and orjson encodes datetimes natively
+        payload = orjson.dumps(analytics)
         data_stream = io.BytesIO(payload)
 
         try:
@@ -298,51 +460,135 @@ class RabbitWorker:
         except S3Error as exc:
             raise RuntimeError(f"Failed to upload report to MinIO: {exc}") from exc
 
-    def _persist_analytics(self, transaction_id: str, analytics: Dict[str, Any], object_key: str) -> None:
+    def _persist_analytics(
+        self,
+        transaction_id: str,
+        analytics: Dict[str, Any],
+        object_key: str,
+        delivery_tag: int,
+        redelivered: bool,
+        now: datetime,
+    ) -> None:
         if self.mongo_collection is None:
             raise RuntimeError("MongoDB collection not initialised")
 
-        document = {
-            **analytics,
-            "report": {
-                "bucket": self.minio_bucket,
-                "object_key": object_key,
-                "secure": self.minio_secure,
-            },
-            "last_updated": datetime.utcnow(),
+        # The analytics dict belongs to this message and is already uploaded, so extend it in place
+        analytics["report"] = {
+            "bucket": self.minio_bucket,
+            "object_key": object_key,
+            "secure": self.minio_secure,
         }
+        analytics["last_updated"] = now
 
-        result = self.mongo_collection.update_one(
-            {"transaction_id": transaction_id},
-            {"$set": document},
-            upsert=True,
+        operation = UpdateOne({"transaction_id": transaction_id}, {"$set": analytics}, upsert=True)
+        with self._mongo_lock:
+            self._mongo_batch.append(PendingWrite(transaction_id, operation, delivery_tag, redelivered))
+            if len(self._mongo_batch) < self.mongo_batch_size:
+                return
+            batch, self._mongo_batch = self._mongo_batch, []
+        self._write_mongo_batch(batch)
+
+    def _flush_mongo(self) -> None:
+        with self._mongo_lock:
+            batch, self._mongo_batch = self._mongo_batch, []
+        if batch:
+            self._write_mongo_batch(batch)
+
+    def _write_mongo_batch(self, batch: List[PendingWrite]) -> None:
+        """Upsert a batch in one round trip, then settle every delivery it was holding exactly once.
+
+        Only connection-level failures are retried, and each delivery at most once; anything else
+        would fail the same way again, so it is logged and acked. Never raises: on the inline path
+        the caller has already handed the ack over to the batch.
+        """
+        try:
+            result = self.mongo_collection.bulk_write([pending.operation for pending in batch], ordered=False)
+            logger.debug(
+                "Stored analytics for %d transactions (%d inserted, %d updated)",
+                len(batch),
+                result.upserted_count,
+                result.matched_count,
+            )
+        except BulkWriteError as exc:
+            # Unordered, so every other operation was applied; only the listed ones were rejected
+            for error in exc.details.get("writeErrors", []):
+                logger.error(
+                    "Error storing analytics for %s, discarding: %s",
+                    batch[error["index"]].transaction_id,
+                    error.get("errmsg"),
+                )
+        except ConnectionFailure as exc:
+            # AutoReconnect, NetworkTimeout, ServerSelectionTimeoutError; upserts are safe to replay
+            self._retry_batch(batch, exc)
+            return
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Error storing analytics batch, discarding %d deliveries", len(batch))
+        for pending in batch:
+            self._ack(pending.delivery_tag)
+
+    def _retry_batch(self, batch: List[PendingWrite], exc: Exception) -> None:
+        """Requeue first deliveries once; drop those that already came back, so an outage cannot loop."""
+        retry = [pending for pending in batch if not pending.redelivered]
+        logger.error(
+            "Error storing analytics batch, requeueing %d and discarding %d redelivered: %s",
+            len(retry),
+            len(batch) - len(retry),
+            exc,
         )
-        matched = result.matched_count if result else 0
-        action = "updated" if matched else "inserted"
-        print(f"[worker] Stored analytics for transaction {transaction_id} ({action})")
+        for pending in batch:
+            if pending.redelivered:
+                self._ack(pending.delivery_tag)
+            else:
+                self._requeue(pending.delivery_tag)
+
+    def _drain(self) -> None:
+        """Stop consuming, let in-flight messages finish, write what they queued, then deliver the acks."""
+        if self._channel and self._channel.is_open and self._channel.consumer_tags:
+            # No new deliveries while the pool drains; unstarted prefetched ones go back to the queue
+            self._channel.stop_consuming()
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            if self.mongo_collection is not None:
+                self._flush_mongo()
+            if self._connection and self._connection.is_open:
+                self._connection.process_data_events(time_limit=0)
+        if self._channel and self._channel.is_open:
+            self._flush_acks()
 
     def close(self) -> None:
-        if self._channel and self._channel.is_open:
-            self._channel.close()
-        if self._connection and self._connection.is_open:
-            self._connection.close()
-        if self.pg_conn:
-            try:
-                self.pg_conn.close()
-            except psycopg.Error:
-                pass
-        if self.mongo_client:
-            self.mongo_client.close()
-        # MinIO client does not need explicit close
+        try:
+            self._drain()
+            if self._channel and self._channel.is_open:
+                self._channel.close()
+            if self._connection and self._connection.is_open:
+                self._connection.close()
+        except Exception as exc:  # pylint: disable=broad-except
+            # A broken broker connection must not keep Postgres, Mongo or the log listener open
+            logger.error("Error closing RabbitMQ connection: %s", exc)
+        finally:
+            self._release_clients()
+
+    def _release_clients(self) -> None:
+        try:
+            if self.pg_pool:
+                try:
+                    self.pg_pool.close()
+                except psycopg.Error:
+                    pass
+            if self.mongo_client:
+                self.mongo_client.close()
+            # MinIO client does not need explicit close
+        finally:
+            self._stop_logging()
 
 
 def handle_shutdown(worker: RabbitWorker):
-    """Signal handler to stop consuming without losing messages."""
+    """Signal handler to stop consuming without losing messages; main() closes the worker."""
 
     def _handler(signum, frame):
-        print(f"\n[worker] Received signal {signum}, shutting down...")
-        worker.close()
-        sys.exit(0)
+        logger.info("Received signal %s, shutting down...", signum)
+        worker.stop()
 
     return _handler
 
@@ -356,9 +602,9 @@ def main():
         worker.connect()
         worker.start()
     except KeyboardInterrupt:
-        print("\n[worker] Interrupted by user")
+        logger.info("Interrupted by user")
     except Exception as exc:  # pylint: disable=broad-except
-        print(f"[worker] Fatal error: {exc}")
+        logger.error("Fatal error: %s", exc)
         sys.exit(1)
     finally:
         worker.close()